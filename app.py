@@ -1,50 +1,64 @@
+import copy
 import os
 import re
+import sys
+import threading
 import zipfile
-from collections import defaultdict
-from dataclasses import dataclass, field
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
-from typing import Generator, Dict, Set
+from typing import Generator, Dict, FrozenSet, List, Tuple
 
 import polib as polib
-from flask import Flask, render_template, request, send_file
+from flask import Flask, Response, render_template, request
 from lxml import etree
 from lxml.etree import Element
 from whitenoise import WhiteNoise
 
 BASE_DIR = os.path.dirname(__file__)
+NAME_RE = re.compile(r'#(?P<filename>[a-zA-Z0-9_-]+):(?P<slug>.+)')
+XML_PARSER = etree.XMLParser(recover=True, remove_blank_text=True, collect_ids=False)
+SUBSTITUTION_CACHE_SIZE = 256
 
 
 class MoFileCache:
-    def __init__(self, path):
-        self.cache = {}
-        for filename in os.listdir(path):
-            self.cache[os.path.splitext(filename)[0]] = polib.mofile(os.path.join(path, filename))
-
-    def __getattr__(self, item):
-        return self.cache.get(item, polib.MOFile())
+    def __init__(self, path, eager_load=False):
+        self.index: Dict[Tuple[str, str], str] = {}
+        self._paths = {
+            os.path.splitext(filename)[0]: os.path.join(path, filename)
+            for filename in os.listdir(path)
+        }
+        if eager_load:
+            for mo_filename in list(self._paths):
+                self._load(mo_filename)
+
+    def _load(self, mo_filename: str):
+        path = self._paths.pop(mo_filename, None)
+        if path is None:
+            return
+        for entry in polib.mofile(path):
+            self.index.setdefault((mo_filename, entry.msgid), entry.msgstr)
 
     def get_name(self, user_string: str):
         if not user_string:
             return None
-        match = re.search("#(?P<filename>[a-zA-Z0-9_-]+):(?P<slug>.+)", user_string)
+        match = NAME_RE.search(user_string)
         if not match:
             return None
-        mo_filename = match.groupdict()['filename']
-        slug = match.groupdict()['slug']
-        entry = getattr(self, mo_filename, None).find(slug)
-        if entry:
-            return entry.msgstr
+        mo_filename = match.group('filename')
+        if mo_filename in self._paths:
+            self._load(mo_filename)
+        return self.index.get((mo_filename, match.group('slug')))
 
 
 def load_xml(path) -> Element:
-    with open(path) as f:
+    with open(path, 'rb') as f:
         return load_xml_from_str(f.read())
 
 
 def load_xml_from_str(content) -> Element:
-    parser = etree.XMLParser(recover=True)
-    return etree.fromstring(content, parser)
+    return etree.fromstring(content, XML_PARSER)
 
 
 def load_special_voice_tags() -> Generator[str, None, None]:
@@ -52,18 +66,24 @@ def load_special_voice_tags() -> Generator[str, None, None]:
     for tank_man in root.find('voiceover'):
         yield tank_man.find('tag').text.strip()
 
-def create_zip_file(files: Dict[str, str]):
+def create_zip_file(files: Dict[str, bytes], compression=zipfile.ZIP_STORED):
+    # The game only loads .wotmod packages whose members are stored uncompressed
     memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_STORED) as archive:
+    with zipfile.ZipFile(memory_file, 'w', compression) as archive:
         for filename, content in files.items():
             archive.writestr(filename, content)
 
-    memory_file.seek(0)
-    return send_file(memory_file, attachment_filename='crew_remap.wotmod', as_attachment=True)
+    return Response(
+        memory_file.getvalue(),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=crew_remap.wotmod'}
+    )
 
 
 @dataclass
 class SubstitutionData:
+    __slots__ = ('first_name', 'last_name', 'icon', 'tags')
+
     first_name: str
     last_name: str
     icon: str
@@ -72,49 +92,54 @@ class SubstitutionData:
 
 @dataclass
 class Tankman:
+    __slots__ = ('first_name', 'last_name', 'icon', 'slug', 'voice_tag', 'nation_data')
+
     first_name: str
     last_name: str
     icon: str
     slug: str
     voice_tag: str
-    nation_data: Dict[str, SubstitutionData] = field(default_factory=dict)
+    nation_data: Dict[str, SubstitutionData]
 
 
 class TankStylesApp(Flask):
-    nation_xmls: Dict[str, str] = {}
+    nation_trees: Dict[str, Element] = {}
+    nation_indices: Dict[str, Dict[str, int]] = {}
     tankmen: Dict[str, Tankman] = {}
+    sorted_tankmen: List[Tankman] = []
+    substituted_tags: Dict[Tuple[str, str, str], str] = {}
+    substitution_cache: 'OrderedDict[Tuple[str, FrozenSet[Tuple[str, str]]], bytes]' = OrderedDict()
+    substitution_cache_lock = threading.Lock()
     g_mo_cache = MoFileCache(os.path.join(BASE_DIR, 'mo'))
 
     def __init__(self, *args, **kwargs):
-        voice_tags = set(load_special_voice_tags())
+        voice_tags = frozenset(load_special_voice_tags())
         self.load_tankmen(voice_tags)
         super().__init__(*args, **kwargs)
 
-    def load_tankmen(self, voice_tags: Set[str]):
+    def load_tankmen(self, voice_tags: FrozenSet[str]):
         for filename in os.listdir('tankmen'):
-            nation = os.path.splitext(filename)[0]
+            nation = sys.intern(os.path.splitext(filename)[0])
 
-            with open(os.path.join(BASE_DIR, 'tankmen', filename)) as f:
-                content = f.read()
-                self.nation_xmls[nation] = content
-                root = load_xml_from_str(content)
+            with open(os.path.join(BASE_DIR, 'tankmen', filename), 'rb') as f:
+                root = load_xml_from_str(f.read())
+                self.nation_trees[nation] = root
 
-            for tankman in root.find('premiumGroups'):
-                slug = tankman.tag
+            indices = self.nation_indices[nation] = {}
+            for i, tankman in enumerate(root.find('premiumGroups')):
+                slug = sys.intern(tankman.tag)
                 if slug.find('race') != -1:
                     continue
 
-                tags = set(getattr(tankman.find('tags'), 'text', '').strip().split(' '))
-                voice_tag = next(iter(tags & voice_tags), None)
+                tags_text = getattr(tankman.find('tags'), 'text', None) or ''
+                voice_tag = next((tag for tag in tags_text.split() if tag in voice_tags), None)
                 if not voice_tag:
                     continue
 
-                first_name = next(iter(tankman.find('firstNames'))).text
-                try:
-                    second_name = next(iter(tankman.find('lastNames'))).text
-                except (StopIteration, AttributeError):
-                    second_name = ""
-                icon = next(iter(tankman.find('icons'))).text
+                first_name = tankman.find('firstNames')[0].text
+                last_names = tankman.find('lastNames')
+                second_name = last_names[0].text if last_names is not None and len(last_names) else ""
+                icon = tankman.find('icons')[0].text
                 if slug not in self.tankmen:
                     last_name = self.g_mo_cache.get_name(second_name.strip())
                     if last_name == '?empty?':
@@ -124,42 +149,70 @@ class TankStylesApp(Flask):
                         last_name,
                         icon.strip(),
                         slug,
-                        voice_tag
+                        voice_tag,
+                        {}
                     )
 
+                indices[slug] = i
                 self.tankmen[slug].nation_data[nation] = SubstitutionData(
                     first_name,
                     second_name,
                     icon,
-                    getattr(tankman.find('tags'), 'text', '')
+                    tags_text
                 )
 
-    def substitute(self, nation, substitutions: Dict[str, str]) -> str:
-        xml = load_xml_from_str(self.nation_xmls[nation])
-        for tankman in xml.find('premiumGroups'):
-            if tankman.tag in substitutions:
-                source = self.tankmen[tankman.tag]
-                target = self.tankmen[substitutions[tankman.tag]]
-                tankman.find('tags').text = target.nation_data[nation].tags.replace(source.voice_tag, target.voice_tag)
-                next(iter(tankman.find('firstNames'))).text = target.nation_data[nation].first_name
-                next(iter(tankman.find('lastNames'))).text = target.nation_data[nation].last_name
-                next(iter(tankman.find('icons'))).text = target.nation_data[nation].icon
-
-        return etree.tostring(xml).decode()
+        self.sorted_tankmen = sorted(self.tankmen.values(), key=lambda x: (x.first_name or '', x.last_name or ''))
+        for source in self.tankmen.values():
+            for target in self.tankmen.values():
+                for nation in source.nation_data.keys() & target.nation_data.keys():
+                    self.substituted_tags[(source.slug, target.slug, nation)] = \
+                        target.nation_data[nation].tags.replace(source.voice_tag, target.voice_tag)
+
+    def substitute(self, nation, substitutions: Dict[str, str]) -> bytes:
+        key = (nation, frozenset(substitutions.items()))
+        with self.substitution_cache_lock:
+            if key in self.substitution_cache:
+                self.substitution_cache.move_to_end(key)
+                return self.substitution_cache[key]
+
+        content = self._substitute(nation, substitutions)
+        with self.substitution_cache_lock:
+            self.substitution_cache[key] = content
+            if len(self.substitution_cache) > SUBSTITUTION_CACHE_SIZE:
+                self.substitution_cache.popitem(last=False)
+        return content
+
+    def _substitute(self, nation, substitutions: Dict[str, str]) -> bytes:
+        xml = copy.deepcopy(self.nation_trees[nation])
+        premium_groups = xml.find('premiumGroups')
+        indices = self.nation_indices[nation]
+        for source_slug, target_slug in substitutions.items():
+            tankman = premium_groups[indices[source_slug]]
+            target = self.tankmen[target_slug]
+            tankman.find('tags').text = self.substituted_tags[(source_slug, target_slug, nation)]
+            tankman.find('firstNames')[0].text = target.nation_data[nation].first_name
+            tankman.find('lastNames')[0].text = target.nation_data[nation].last_name
+            tankman.find('icons')[0].text = target.nation_data[nation].icon
+
+        return etree.tostring(xml)
 
     def create_modpack(self, form):
         nation_substitutions = defaultdict(dict)
-        for source_slug in [key for key, value in form.items() if key in app.tankmen and value != ""]:
-            target_slug = form.get(source_slug)
-            if target_slug not in self.tankmen:
+        tankmen = self.tankmen
+        for source_slug, target_slug in form.items():
+            if not target_slug or source_slug not in tankmen or target_slug not in tankmen:
                 continue
 
-            for nation in self.tankmen[source_slug].nation_data.keys():
+            for nation in tankmen[source_slug].nation_data.keys():
                 nation_substitutions[nation][source_slug] = target_slug
 
+        # lxml releases the GIL while serializing, so nations can be processed concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(nation_substitutions)))) as executor:
+            contents = list(executor.map(self.substitute, nation_substitutions.keys(), nation_substitutions.values()))
+
         return create_zip_file(
-            {f'res/scripts/item_defs/tankmen/{nation}.xml': self.substitute(nation, substitutions)
-             for nation, substitutions in nation_substitutions.items()}
+            {f'res/scripts/item_defs/tankmen/{nation}.xml': content
+             for nation, content in zip(nation_substitutions.keys(), contents)}
         )
 
 
@@ -175,7 +228,7 @@ app.wsgi_app = WhiteNoise(
 def tankmen():
     if request.method == 'POST':
         return app.create_modpack(request.form)
-    return render_template('tankmen.html', tankmen=sorted(app.tankmen.values(), key=lambda x: f'{x.first_name}{x.last_name}'))
+    return render_template('tankmen.html', tankmen=app.sorted_tankmen)
 
 
 if __name__ == "__main__":